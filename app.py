@@ -1,15 +1,33 @@
 from datetime import datetime, timedelta
-import secrets
+import base64
+import collections
+import hashlib
+import hmac
+import json
+import threading
+import time
 import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from types import MappingProxyType
 import re
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, insert, update, bindparam, event
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import deferred, joinedload, load_only, selectinload, make_transient_to_detached
+from sqlalchemy.schema import CreateIndex
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, BooleanField
-from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError
-from werkzeug.security import generate_password_hash, check_password_hash
+from wtforms.validators import DataRequired, EqualTo, Length, ValidationError
+from argon2 import PasswordHasher
+from argon2.exceptions import VerificationError, InvalidHashError
+from cachetools import TTLCache, cached
+from jinja2 import FileSystemBytecodeCache
 from dotenv import load_dotenv
-from security_utils import rate_limit, SessionManager, init_security_headers, log_security_event
+from security_utils import (SessionManager, get_client_ip, init_security_headers, init_session_check,
+                            log_security_event, rate_limit, rate_limiter)
 from flask_admin import Admin
 from flask_admin.contrib.sqla import ModelView
 
@@ -33,13 +51,89 @@ app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 if os.environ.get('FLASK_ENV') == 'production':
     app.config['DEBUG'] = False
     app.config['TESTING'] = False
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = False
 else:
     app.config['DEBUG'] = True
 
-db = SQLAlchemy(app)
+# Compiled templates are shared between workers and survive restarts
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+
+# Sessions are request-scoped, so committed objects stay usable without a reload
+db = SQLAlchemy(app, session_options={'expire_on_commit': False})
+
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    # WAL lets readers proceed during writes; NORMAL skips the fsync on every commit
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite':
+        event.listen(db.engine, 'connect', _configure_sqlite_connection)
+
+# Optional Redis: server-side sessions and short-lived caches of user rows and the catalog
+redis_client = None
+if os.environ.get('REDIS_URL'):
+    import redis
+    from flask_session import Session
+    
+    redis_client = redis.Redis.from_url(os.environ['REDIS_URL'])
+    app.config['SESSION_TYPE'] = 'redis'
+    app.config['SESSION_REDIS'] = redis_client
+    Session(app)
+    rate_limiter.use_redis(redis_client)
+
+# Argon2id password hasher with OWASP's baseline parameters (19 MiB, 2 passes).
+# PBKDF2 hashes and Argon2 hashes with other parameters are upgraded on login.
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19 * 1024, parallelism=1)
+
+# KDF work runs here; argon2 and hashlib release the GIL, so verifications run in parallel
+_hash_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix='password-hash')
+
+# Verified against when no account matches, so unknown usernames cost as much as wrong passwords
+_DUMMY_PASSWORD_HASH = password_hasher.hash('shalabiverse-dummy-password')
+
+def verify_dummy_password(password):
+    """Spend one password verification without an account to check"""
+    try:
+        _hash_executor.submit(password_hasher.verify, _DUMMY_PASSWORD_HASH, password).result()
+    except VerificationError:
+        pass
+
+# Short-lived cache of successful password verifications (failures are never cached)
+_password_cache = TTLCache(maxsize=10000, ttl=30)
+_password_cache_lock = threading.Lock()
+
+def _password_cache_key(password_hash, password):
+    return hashlib.sha256(f'{password_hash}:{password}'.encode()).digest()
+
+# Reset tokens are cut from one urandom read per batch instead of one read per request
+_RESET_TOKEN_BYTES = 32
+_RESET_TOKEN_BATCH = 64
+_reset_token_pool = collections.deque()
+_reset_token_lock = threading.Lock()
+# A forked worker must never hand out tokens its parent (or a sibling) also holds
+os.register_at_fork(after_in_child=_reset_token_pool.clear)
+
+def new_reset_token():
+    with _reset_token_lock:
+        if not _reset_token_pool:
+            entropy = os.urandom(_RESET_TOKEN_BYTES * _RESET_TOKEN_BATCH)
+            _reset_token_pool.extend(
+                base64.urlsafe_b64encode(entropy[i:i + _RESET_TOKEN_BYTES]).rstrip(b'=').decode('ascii')
+                for i in range(0, len(entropy), _RESET_TOKEN_BYTES)
+            )
+        return _reset_token_pool.popleft()
+
+def hash_reset_token(token):
+    """Reset tokens are stored and looked up by a 16-byte digest, never in plaintext"""
+    return hashlib.sha256(token.encode()).digest()[:16].hex()
 
 # Initialize security headers
 init_security_headers(app)
+init_session_check(app)
 
 # Initialize Flask-Admin
 admin = Admin(app, name='Shalabiverse Admin', template_mode='bootstrap3')
@@ -53,31 +147,89 @@ class User(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
     is_active = db.Column(db.Boolean, default=True)
-    reset_token = db.Column(db.String(100), unique=True)
+    reset_token = db.Column(db.String(32), unique=True)
     reset_token_expires = db.Column(db.DateTime)
     
+    __table_args__ = (
+        db.Index('ix_user_email_lower', db.func.lower(email)),
+        db.Index('ix_user_reset_exp', reset_token_expires),
+        db.Index('ix_user_username_active', username,
+                 postgresql_where=(is_active == True), sqlite_where=(is_active == True)),
+    )
+    
     # Relationships
     enrollments = db.relationship('Enrollment', backref='user', lazy=True)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password, method='pbkdf2:sha256', salt_length=16)
+        self.password_hash = password_hasher.hash(password)
+        if self.id is not None:
+            invalidate_cached_user(self.id)
+    
+    @classmethod
+    def bulk_create(cls, records):
+        """Build users from (username, email, password) records, reading every salt in one urandom call"""
+        salt_len = password_hasher.salt_len
+        entropy = os.urandom(salt_len * len(records))
+        users = []
+        for i, (username, email, password) in enumerate(records):
+            user = cls(username=username, email=email)
+            user.password_hash = password_hasher.hash(
+                password, salt=entropy[i * salt_len:(i + 1) * salt_len]
+            )
+            users.append(user)
+        return users
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        cache_key = _password_cache_key(self.password_hash, password)
+        with _password_cache_lock:
+            cached = _password_cache.get(cache_key)
+        if cached is not None and hmac.compare_digest(cached, cache_key):
+            return True
+        
+        if not self._verify_password(password):
+            return False
+        
+        # Key on the stored hash, which may have just been upgraded
+        cache_key = _password_cache_key(self.password_hash, password)
+        with _password_cache_lock:
+            _password_cache[cache_key] = cache_key
+        return True
+    
+    def _verify_password(self, password):
+        if self.password_hash.startswith('pbkdf2:'):
+            # Legacy Werkzeug hash: verify it, then migrate to Argon2id
+            from werkzeug.security import check_password_hash
+            if not _hash_executor.submit(check_password_hash, self.password_hash, password).result():
+                return False
+            self.set_password(password)
+            return True
+        
+        try:
+            _hash_executor.submit(password_hasher.verify, self.password_hash, password).result()
+        except (VerificationError, InvalidHashError):
+            return False
+        
+        if password_hasher.check_needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
     def generate_reset_token(self):
-        self.reset_token = secrets.token_urlsafe(32)
+        token = new_reset_token()
+        self.reset_token = hash_reset_token(token)
         self.reset_token_expires = datetime.utcnow() + timedelta(hours=1)
-        return self.reset_token
+        return token
     
     def verify_reset_token(self, token):
-        return (self.reset_token == token and 
-                self.reset_token_expires and 
+        if self.reset_token is None or token is None:
+            return False
+        return (hmac.compare_digest(self.reset_token, hash_reset_token(token)) and
+                self.reset_token_expires is not None and
                 self.reset_token_expires > datetime.utcnow())
     
     def clear_reset_token(self):
         self.reset_token = None
         self.reset_token_expires = None
+        invalidate_cached_user(self.id)
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -85,20 +237,21 @@ class User(db.Model):
 # Course Models
 class Course(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    # Pages render the Arabic text; English columns load as one group only when touched
     title_ar = db.Column(db.String(200), nullable=False)
-    title_en = db.Column(db.String(200), nullable=False)
+    title_en = deferred(db.Column(db.String(200), nullable=False), group='en')
     description_ar = db.Column(db.Text, nullable=False)
-    description_en = db.Column(db.Text, nullable=False)
+    description_en = deferred(db.Column(db.Text, nullable=False), group='en')
     what_you_learn_ar = db.Column(db.Text, nullable=False)
-    what_you_learn_en = db.Column(db.Text, nullable=False)
+    what_you_learn_en = deferred(db.Column(db.Text, nullable=False), group='en')
     target_audience_ar = db.Column(db.Text, nullable=False)
-    target_audience_en = db.Column(db.Text, nullable=False)
+    target_audience_en = deferred(db.Column(db.Text, nullable=False), group='en')
     requirements_ar = db.Column(db.Text, nullable=False)
-    requirements_en = db.Column(db.Text, nullable=False)
+    requirements_en = deferred(db.Column(db.Text, nullable=False), group='en')
     instructor_name_ar = db.Column(db.String(100), nullable=False)
-    instructor_name_en = db.Column(db.String(100), nullable=False)
+    instructor_name_en = deferred(db.Column(db.String(100), nullable=False), group='en')
     instructor_bio_ar = db.Column(db.Text, nullable=False)
-    instructor_bio_en = db.Column(db.Text, nullable=False)
+    instructor_bio_en = deferred(db.Column(db.Text, nullable=False), group='en')
     price = db.Column(db.Float, nullable=False, default=0.0)
     duration_hours = db.Column(db.Integer, nullable=False)
     level = db.Column(db.String(20), nullable=False)  # beginner, intermediate, advanced
@@ -107,8 +260,13 @@ class Course(db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_course_active_id', is_active, id),
+    )
+    
     # Relationships
-    modules = db.relationship('Module', backref='course', lazy=True, cascade='all, delete-orphan')
+    modules = db.relationship('Module', back_populates='course', lazy=True,
+                              order_by='Module.order_index', cascade='all, delete-orphan')
     enrollments = db.relationship('Enrollment', backref='course', lazy=True)
 
 class Module(db.Model):
@@ -121,7 +279,9 @@ class Module(db.Model):
     order_index = db.Column(db.Integer, nullable=False)
     
     # Relationships
-    lessons = db.relationship('Lesson', backref='module', lazy=True, cascade='all, delete-orphan')
+    course = db.relationship('Course', back_populates='modules')
+    lessons = db.relationship('Lesson', back_populates='module', lazy=True,
+                              order_by='Lesson.order_index', cascade='all, delete-orphan')
 
 class Lesson(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -136,6 +296,7 @@ class Lesson(db.Model):
     is_free = db.Column(db.Boolean, default=False)
     
     # Relationships
+    module = db.relationship('Module', back_populates='lessons', lazy=True)
     progress = db.relationship('LessonProgress', backref='lesson', lazy=True)
 
 class Enrollment(db.Model):
@@ -147,6 +308,12 @@ class Enrollment(db.Model):
     progress_percentage = db.Column(db.Float, default=0.0)
     last_accessed = db.Column(db.DateTime)
     
+    # A unique index rather than a constraint so create_missing_indexes can add it to existing tables
+    __table_args__ = (
+        db.Index('ix_enrollment_user_course', user_id, course_id, unique=True),
+        db.Index('ix_enrollment_user_active', user_id, is_active),
+    )
+    
     # Relationships
     lesson_progress = db.relationship('LessonProgress', backref='enrollment', lazy=True)
 
@@ -157,6 +324,11 @@ class LessonProgress(db.Model):
     is_completed = db.Column(db.Boolean, default=False)
     completed_at = db.Column(db.DateTime)
     watch_time_seconds = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (
+        db.Index('ix_lesson_progress_enrollment_lesson', enrollment_id, lesson_id, unique=True),
+        db.Index('ix_lesson_progress_enrollment_done', enrollment_id, is_completed),
+    )
 
 # Enrollment Request Model (for simple form submissions)
 class EnrollmentRequest(db.Model):
@@ -172,32 +344,109 @@ class EnrollmentRequest(db.Model):
     # Relationship
     course_ref = db.relationship('Course', backref='enrollment_requests')
 
+# Prebuilt user lookups; bound parameters keep SQLAlchemy's compiled-SQL cache warm
+_user_by_username = select(User).where(User.username == bindparam('username'))
+_user_by_email = select(User).where(db.func.lower(User.email) == bindparam('email'))
+_user_by_reset_token = select(User).where(User.reset_token == bindparam('token'))
+
+_user_conflicts = select(User.username, User.email).where(
+    (User.username == bindparam('username')) | (db.func.lower(User.email) == bindparam('email'))
+).limit(2)
+
+# Core UPDATE: skips ORM dirty-checking for a column nothing else reads during login
+_touch_last_login = update(User.__table__).where(
+    User.__table__.c.id == bindparam('user_id')
+).values(last_login=bindparam('login_time'))
+
+# Dashboard course cards show only these; the long Arabic/English text stays in the database
+_course_card_columns = load_only(Course.id, Course.title_ar, Course.price)
+
+_login_columns = load_only(User.id, User.username, User.email, User.password_hash, User.is_active)
+_login_user_by_username = _user_by_username.options(_login_columns)
+_login_user_by_email = _user_by_email.options(_login_columns)
+
 # Flask-Admin Model Views
-admin.add_view(ModelView(User, db.session, name='Users'))
-admin.add_view(ModelView(Course, db.session, name='Courses'))
+class CourseAdminView(ModelView):
+    """Course admin that drops the cached catalog whenever a course changes"""
+    
+    # The long Arabic/English text is edited on the form, not listed
+    column_list = ('id', 'title_ar', 'title_en', 'category', 'level', 'price', 'is_active')
+    column_default_sort = ('id', True)
+    page_size = 50
+    
+    def get_query(self):
+        return super().get_query().options(load_only(
+            Course.id, Course.title_ar, Course.title_en, Course.category,
+            Course.level, Course.price, Course.is_active
+        ))
+    
+    def after_model_change(self, form, model, is_created):
+        invalidate_catalog_cache()
+    
+    def after_model_delete(self, model):
+        invalidate_catalog_cache()
+
+class UserAdminView(ModelView):
+    """User admin that drops the cached user so edits and deletions apply on the next request"""
+    
+    def after_model_change(self, form, model, is_created):
+        invalidate_cached_user(model.id)
+    
+    def after_model_delete(self, model):
+        invalidate_cached_user(model.id)
+
+class ProgressAdminView(ModelView):
+    """Admin for enrollments and lesson progress that drops the cached dashboards on any change"""
+    
+    def after_model_change(self, form, model, is_created):
+        invalidate_dashboard_cache()
+    
+    def after_model_delete(self, model):
+        invalidate_dashboard_cache()
+
+admin.add_view(UserAdminView(User, db.session, name='Users'))
+admin.add_view(CourseAdminView(Course, db.session, name='Courses'))
 admin.add_view(ModelView(Module, db.session, name='Modules'))
 admin.add_view(ModelView(Lesson, db.session, name='Lessons'))
-admin.add_view(ModelView(Enrollment, db.session, name='Enrollments'))
-admin.add_view(ModelView(LessonProgress, db.session, name='Lesson Progress'))
+admin.add_view(ProgressAdminView(Enrollment, db.session, name='Enrollments'))
+admin.add_view(ProgressAdminView(LessonProgress, db.session, name='Lesson Progress'))
 admin.add_view(ModelView(EnrollmentRequest, db.session, name='Enrollment Requests'))
 
 # Custom Validators
+_match_username = re.compile(r'^[a-zA-Z0-9_]+$').match
+_match_email = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$').match
+
+# Byte -> character class: 1 uppercase, 2 lowercase, 4 digit, 0 anything else
+_PASSWORD_CLASS_TABLE = bytes(
+    1 if 65 <= c <= 90 else 2 if 97 <= c <= 122 else 4 if 48 <= c <= 57 else 0
+    for c in range(256)
+)
+
 def validate_password_strength(form, field):
     password = field.data
     if len(password) < 8:
         raise ValidationError('Password must be at least 8 characters long.')
-    if not re.search(r'[A-Z]', password):
+    
+    # One C-level translate pass classifies every character
+    classes = set(password.encode('utf-8', 'ignore').translate(_PASSWORD_CLASS_TABLE))
+    
+    if 1 not in classes:
         raise ValidationError('Password must contain at least one uppercase letter.')
-    if not re.search(r'[a-z]', password):
+    if 2 not in classes:
         raise ValidationError('Password must contain at least one lowercase letter.')
-    if not re.search(r'[0-9]', password):
+    if 4 not in classes:
         raise ValidationError('Password must contain at least one number.')
 
 def validate_username_format(form, field):
     username = field.data
-    if not re.match(r'^[a-zA-Z0-9_]+$', username):
+    if not _match_username(username):
         raise ValidationError('Username can only contain letters, numbers, and underscores.')
 
+def validate_email_format(form, field):
+    email = field.data or ''
+    if len(email) > 120 or not _match_email(email):
+        raise ValidationError('يرجى إدخال بريد إلكتروني صحيح.')
+
 # Forms
 class RegistrationForm(FlaskForm):
     username = StringField('اسم المستخدم', validators=[
@@ -207,7 +456,7 @@ class RegistrationForm(FlaskForm):
     ])
     email = StringField('البريد الإلكتروني', validators=[
         DataRequired(message='البريد الإلكتروني مطلوب.'),
-        Email(message='يرجى إدخال بريد إلكتروني صحيح.')
+        validate_email_format
     ])
     password = PasswordField('كلمة المرور', validators=[
         DataRequired(message='كلمة المرور مطلوبة.'),
@@ -219,15 +468,18 @@ class RegistrationForm(FlaskForm):
     ])
     submit = SubmitField('إنشاء حساب')
     
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user:
-            raise ValidationError('Username already exists. Please choose a different one.')
-    
-    def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user:
-            raise ValidationError('Email address already registered. Please use a different email.')
+    def add_conflict_errors(self):
+        """Attribute a unique-constraint conflict to the right fields with a single SELECT"""
+        username = self.username.data
+        email = (self.email.data or '').lower()
+        conflicts = db.session.execute(
+            _user_conflicts, {'username': username, 'email': email}
+        ).all()
+        for existing_username, existing_email in conflicts:
+            if existing_username == username:
+                self.username.errors.append('Username already exists. Please choose a different one.')
+            if existing_email.lower() == email:
+                self.email.errors.append('Email address already registered. Please use a different email.')
 
 class LoginForm(FlaskForm):
     username = StringField('اسم المستخدم أو البريد الإلكتروني', validators=[
@@ -242,7 +494,7 @@ class LoginForm(FlaskForm):
 class ForgotPasswordForm(FlaskForm):
     email = StringField('البريد الإلكتروني', validators=[
         DataRequired(message='البريد الإلكتروني مطلوب.'),
-        Email(message='يرجى إدخال بريد إلكتروني صحيح.')
+        validate_email_format
     ])
     submit = SubmitField('إرسال رابط إعادة التعيين')
 
@@ -258,155 +510,355 @@ class ResetPasswordForm(FlaskForm):
     submit = SubmitField('إعادة تعيين كلمة المرور')
 
 # Helper Functions
+def without_autoflush(view):
+    """Run a view with autoflush off; it only reads, or commits its writes itself"""
+    @wraps(view)
+    def decorated_function(*args, **kwargs):
+        with db.session.no_autoflush:
+            return view(*args, **kwargs)
+    return decorated_function
+
+def insert_ignoring_conflicts(model):
+    """INSERT that skips rows violating a unique constraint where the backend supports it"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(model).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return sqlite.insert(model).on_conflict_do_nothing()
+    return insert(model)
+
+def upsert(model, values, index_elements, update_columns):
+    """INSERT that updates update_columns when index_elements already match a row, where supported"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(model).values(**values)
+    elif dialect == 'sqlite':
+        stmt = sqlite.insert(model).values(**values)
+    else:
+        return insert(model).values(**values)
+    return stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={name: stmt.excluded[name] for name in update_columns}
+    )
+
+class LastLoginWriter:
+    """Coalesce last_login updates and write them off the request path"""
+    
+    def __init__(self, delay=0.5):
+        self.delay = delay
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='last-login')
+    
+    def record(self, user_id, login_time):
+        with self._lock:
+            schedule_flush = not self._pending
+            self._pending[user_id] = login_time
+        if schedule_flush:
+            self._executor.submit(self._flush)
+    
+    def _flush(self):
+        time.sleep(self.delay)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        
+        with app.app_context():
+            try:
+                db.session.execute(_touch_last_login, [
+                    {'user_id': user_id, 'login_time': login_time}
+                    for user_id, login_time in pending.items()
+                ])
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f'Error writing last_login: {e}')
+        
+        for user_id in pending:
+            invalidate_cached_user(user_id)
+
+last_login_writer = LastLoginWriter()
+
 def get_user_by_username_or_email(username_or_email):
     """Get user by username or email"""
-    return User.query.filter(
-        (User.username == username_or_email) | (User.email == username_or_email)
-    ).first()
+    username_or_email = username_or_email.strip()
+    # Usernames cannot contain '@', so only one indexed column needs probing
+    if '@' in username_or_email:
+        result = db.session.execute(_login_user_by_email, {'email': username_or_email.lower()})
+    else:
+        result = db.session.execute(_login_user_by_username, {'username': username_or_email})
+    return result.scalar_one_or_none()
+
+# The public catalog is cached as plain mappings for five minutes and dropped on admin edits.
+# With Redis every worker shares one copy; otherwise each worker keeps its own.
+CATALOG_CACHE_TTL = 300  # seconds
+_CATALOG_CACHE_KEY = 'catalog:active'
+_CATALOG_COLUMNS = ('id', 'title_ar', 'description_ar', 'instructor_name_ar',
+                    'duration_hours', 'level', 'price', 'image_url')
+_catalog_cache = TTLCache(maxsize=1, ttl=CATALOG_CACHE_TTL)
+_catalog_cache_lock = threading.Lock()
+
+def invalidate_catalog_cache():
+    """Forget the cached course catalog"""
+    with _catalog_cache_lock:
+        _catalog_cache.clear()
+    if redis_client is not None:
+        try:
+            redis_client.delete(_CATALOG_CACHE_KEY)
+        except redis.RedisError:
+            pass
+
+def get_active_courses():
+    """Active courses for the catalog page, detached from the session"""
+    if redis_client is None:
+        return _get_local_active_courses()
+    try:
+        data = redis_client.get(_CATALOG_CACHE_KEY)
+    except redis.RedisError:
+        return _get_local_active_courses()
+    
+    if data is not None:
+        rows = json.loads(data)
+    else:
+        rows = _query_active_courses()
+        try:
+            redis_client.setex(_CATALOG_CACHE_KEY, CATALOG_CACHE_TTL, json.dumps(rows))
+        except redis.RedisError:
+            pass
+    return tuple(MappingProxyType(row) for row in rows)
+
+@cached(_catalog_cache, key=lambda: 'active', lock=_catalog_cache_lock)
+def _get_local_active_courses():
+    return tuple(MappingProxyType(row) for row in _query_active_courses())
+
+def _query_active_courses():
+    courses = Course.query.options(
+        load_only(*(getattr(Course, name) for name in _CATALOG_COLUMNS))
+    ).filter_by(is_active=True).all()
+    return [{name: getattr(course, name) for name in _CATALOG_COLUMNS} for course in courses]
+
+# Dashboard data is cached per user for a minute and dropped when progress changes
+_dashboard_cache_lock = threading.Lock()
+_user_stats_cache = TTLCache(maxsize=10000, ttl=60)
+_recent_activities_cache = TTLCache(maxsize=10000, ttl=60)
+
+_EMPTY_USER_STATS = MappingProxyType({
+    'courses_enrolled': 0,
+    'study_hours': 0.0,
+    'achievements': 0,
+    'points': 0
+})
+
+_WELCOME_ACTIVITIES = (MappingProxyType({
+    'icon': 'fa-star',
+    'description': 'مرحباً بك في شلبي فيرس! ابدأ رحلتك التعليمية الآن',
+    'timestamp': 'الآن'
+}),)
+
+def invalidate_dashboard_cache(user_id=None):
+    """Forget cached dashboard data for a user, or for everyone when no user is given"""
+    with _dashboard_cache_lock:
+        if user_id is None:
+            _user_stats_cache.clear()
+            _recent_activities_cache.clear()
+        else:
+            _user_stats_cache.pop(user_id, None)
+            _recent_activities_cache.pop(user_id, None)
 
 def get_user_stats(user):
     """Get user statistics for dashboard"""
     try:
-        # Get actual enrolled courses count
-        courses_enrolled = Enrollment.query.filter_by(user_id=user.id, is_active=True).count()
-        
-        # Calculate total study hours from completed lessons
-        total_study_minutes = db.session.query(db.func.sum(Lesson.duration_minutes)).join(
-            LessonProgress, Lesson.id == LessonProgress.lesson_id
-        ).join(
-            Enrollment, LessonProgress.enrollment_id == Enrollment.id
-        ).filter(
-            Enrollment.user_id == user.id,
-            LessonProgress.is_completed == True
-        ).scalar() or 0
-        
-        study_hours = round(total_study_minutes / 60, 1)
-        
-        # Calculate achievements (completed courses + milestones)
-        completed_courses = Enrollment.query.filter_by(
-            user_id=user.id, 
-            is_active=True
-        ).filter(Enrollment.progress_percentage >= 100).count()
-        
-        # Achievement milestones: first course, 5 hours study, 10 hours study, etc.
-        achievements = completed_courses
-        if study_hours >= 5:
-            achievements += 1
-        if study_hours >= 10:
-            achievements += 1
-        if study_hours >= 25:
-            achievements += 1
-        if study_hours >= 50:
-            achievements += 1
-        
-        # Calculate points (simple scoring system)
-        points = (completed_courses * 100) + (int(study_hours) * 10) + (achievements * 25)
-        
-        return {
-            'courses_enrolled': courses_enrolled,
-            'study_hours': study_hours,
-            'achievements': achievements,
-            'points': points
-        }
+        return _load_user_stats(user.id)
     except Exception as e:
         print(f"Error getting user stats: {e}")
-        # Return default values if database query fails
-        return {
-            'courses_enrolled': 0,
-            'study_hours': 0.0,
-            'achievements': 0,
-            'points': 0
-        }
+        # Return default values if database query fails; failures are never cached
+        return _EMPTY_USER_STATS
+
+@cached(_user_stats_cache, key=lambda user_id: user_id, lock=_dashboard_cache_lock)
+def _load_user_stats(user_id):
+    # Get actual enrolled courses count
+    courses_enrolled = Enrollment.query.filter_by(user_id=user_id, is_active=True).count()
+    
+    # Calculate total study hours from completed lessons
+    total_study_minutes = db.session.query(db.func.sum(Lesson.duration_minutes)).join(
+        LessonProgress, Lesson.id == LessonProgress.lesson_id
+    ).join(
+        Enrollment, LessonProgress.enrollment_id == Enrollment.id
+    ).filter(
+        Enrollment.user_id == user_id,
+        LessonProgress.is_completed == True
+    ).scalar() or 0
+    
+    study_hours = round(total_study_minutes / 60, 1)
+    
+    # Calculate achievements (completed courses + milestones)
+    completed_courses = Enrollment.query.filter_by(
+        user_id=user_id, 
+        is_active=True
+    ).filter(Enrollment.progress_percentage >= 100).count()
+    
+    # Achievement milestones: first course, 5 hours study, 10 hours study, etc.
+    achievements = completed_courses
+    if study_hours >= 5:
+        achievements += 1
+    if study_hours >= 10:
+        achievements += 1
+    if study_hours >= 25:
+        achievements += 1
+    if study_hours >= 50:
+        achievements += 1
+    
+    # Calculate points (simple scoring system)
+    points = (completed_courses * 100) + (int(study_hours) * 10) + (achievements * 25)
+    
+    return MappingProxyType({
+        'courses_enrolled': courses_enrolled,
+        'study_hours': study_hours,
+        'achievements': achievements,
+        'points': points
+    })
+
+def _time_ago(moment):
+    time_diff = datetime.utcnow() - moment
+    if time_diff.days == 0:
+        if time_diff.seconds < 3600:
+            return f"{time_diff.seconds // 60} دقيقة مضت"
+        return f"{time_diff.seconds // 3600} ساعة مضت"
+    return f"{time_diff.days} يوم مضى"
 
 def get_recent_activities(user):
     """Get recent user activities"""
     try:
-        activities = []
-        
-        # Get recent lesson completions
-        recent_completions = db.session.query(
-            LessonProgress, Lesson, Course
-        ).join(
-            Lesson, LessonProgress.lesson_id == Lesson.id
-        ).join(
-            Enrollment, LessonProgress.enrollment_id == Enrollment.id
-        ).join(
-            Course, Enrollment.course_id == Course.id
-        ).filter(
-            Enrollment.user_id == user.id,
-            LessonProgress.is_completed == True,
-            LessonProgress.completed_at.isnot(None)
-        ).order_by(
-            LessonProgress.completed_at.desc()
-        ).limit(5).all()
-        
-        for progress, lesson, course in recent_completions:
-            time_diff = datetime.utcnow() - progress.completed_at
-            if time_diff.days == 0:
-                if time_diff.seconds < 3600:
-                    time_str = f"{time_diff.seconds // 60} دقيقة مضت"
-                else:
-                    time_str = f"{time_diff.seconds // 3600} ساعة مضت"
-            else:
-                time_str = f"{time_diff.days} يوم مضى"
-                
-            activities.append({
-                'icon': 'fa-check-circle',
-                'description': f'أكمل درس "{lesson.title_ar}" في كورس "{course.title_ar}"',
-                'timestamp': time_str
-            })
-        
-        # Get recent enrollments
-        recent_enrollments = db.session.query(
-            Enrollment, Course
-        ).join(
-            Course, Enrollment.course_id == Course.id
-        ).filter(
-            Enrollment.user_id == user.id
-        ).order_by(
-            Enrollment.enrolled_at.desc()
-        ).limit(3).all()
-        
-        for enrollment, course in recent_enrollments:
-            time_diff = datetime.utcnow() - enrollment.enrolled_at
-            if time_diff.days == 0:
-                if time_diff.seconds < 3600:
-                    time_str = f"{time_diff.seconds // 60} دقيقة مضت"
-                else:
-                    time_str = f"{time_diff.seconds // 3600} ساعة مضت"
-            else:
-                time_str = f"{time_diff.days} يوم مضى"
-                
-            activities.append({
-                'icon': 'fa-book-open',
-                'description': f'انضم إلى كورس "{course.title_ar}"',
-                'timestamp': time_str
-            })
-        
-        # Sort all activities by most recent and limit to 5
-        # Since we can't sort mixed datetime objects easily, we'll use a simple approach
-        # In a real implementation, you might want to add a unified activity log table
-        
-        # If no activities, show welcome message
-        if not activities:
-            activities.append({
-                'icon': 'fa-star',
-                'description': 'مرحباً بك في شلبي فيرس! ابدأ رحلتك التعليمية الآن',
-                'timestamp': 'الآن'
-            })
-        
-        return activities[:5]  # Return max 5 activities
-        
+        activities = _load_recent_activities(user.id)
     except Exception as e:
         print(f"Error getting recent activities: {e}")
-        # Return default activities if database query fails
-        return [{
-            'icon': 'fa-star',
-            'description': 'مرحباً بك في شلبي فيرس! ابدأ رحلتك التعليمية الآن',
-            'timestamp': 'الآن'
-        }]
+        # Return default activities if database query fails; failures are never cached
+        return _WELCOME_ACTIVITIES
+    
+    # If no activities, show welcome message
+    if not activities:
+        return _WELCOME_ACTIVITIES
+    
+    # Relative times are worked out per request so cached entries do not freeze them
+    return tuple(
+        {'icon': icon, 'description': description, 'timestamp': _time_ago(moment)}
+        for icon, description, moment in activities
+    )
+
+@cached(_recent_activities_cache, key=lambda user_id: user_id, lock=_dashboard_cache_lock)
+def _load_recent_activities(user_id):
+    """Return up to 5 (icon, description, datetime) entries for a user's recent activity"""
+    activities = []
+    
+    # Get recent lesson completions
+    recent_completions = db.session.query(
+        LessonProgress, Lesson, Course
+    ).join(
+        Lesson, LessonProgress.lesson_id == Lesson.id
+    ).join(
+        Enrollment, LessonProgress.enrollment_id == Enrollment.id
+    ).join(
+        Course, Enrollment.course_id == Course.id
+    ).filter(
+        Enrollment.user_id == user_id,
+        LessonProgress.is_completed == True,
+        LessonProgress.completed_at.isnot(None)
+    ).order_by(
+        LessonProgress.completed_at.desc()
+    ).limit(5).all()
+    
+    for progress, lesson, course in recent_completions:
+        activities.append((
+            'fa-check-circle',
+            f'أكمل درس "{lesson.title_ar}" في كورس "{course.title_ar}"',
+            progress.completed_at
+        ))
+    
+    # Get recent enrollments
+    recent_enrollments = db.session.query(
+        Enrollment, Course
+    ).join(
+        Course, Enrollment.course_id == Course.id
+    ).filter(
+        Enrollment.user_id == user_id
+    ).order_by(
+        Enrollment.enrolled_at.desc()
+    ).limit(3).all()
+    
+    for enrollment, course in recent_enrollments:
+        activities.append((
+            'fa-book-open',
+            f'انضم إلى كورس "{course.title_ar}"',
+            enrollment.enrolled_at
+        ))
+    
+    # Sort all activities by most recent and limit to 5
+    # Since we can't sort mixed datetime objects easily, we'll use a simple approach
+    # In a real implementation, you might want to add a unified activity log table
+    return tuple(activities[:5])  # Return max 5 activities
 
 # Session Management
+USER_CACHE_TTL = 300  # seconds
+_USER_CACHE_FIELDS = ('id', 'username', 'email', 'created_at', 'last_login')
+_USER_CACHE_DATES = ('created_at', 'last_login')
+
+def _user_cache_key(user_id):
+    return f'user:{user_id}'
+
+def get_cached_user(user_id):
+    """Rebuild a user from the Redis cache without a query; None on a miss"""
+    if redis_client is None:
+        return None
+    try:
+        data = redis_client.get(_user_cache_key(user_id))
+    except redis.RedisError:
+        return None
+    if data is None:
+        return None
+    
+    fields = json.loads(data)
+    for name in _USER_CACHE_DATES:
+        if fields[name]:
+            fields[name] = datetime.fromisoformat(fields[name])
+    
+    # Attach as a persistent row; columns not cached load on first access
+    user = User(**fields)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def cache_user(user):
+    if redis_client is None:
+        return
+    fields = {name: getattr(user, name) for name in _USER_CACHE_FIELDS}
+    for name in _USER_CACHE_DATES:
+        if fields[name]:
+            fields[name] = fields[name].isoformat()
+    try:
+        redis_client.setex(_user_cache_key(user.id), USER_CACHE_TTL, json.dumps(fields))
+    except redis.RedisError:
+        pass
+
+def invalidate_cached_user(user_id):
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(_user_cache_key(user_id))
+    except redis.RedisError:
+        pass
+
+def load_request_user(user_id):
+    """Load the logged-in user at most once per request"""
+    user = g.get('_user')
+    if user is None or user.id != user_id:
+        user = get_cached_user(user_id)
+        if user is None:
+            user = db.session.get(User, user_id, options=[load_only(
+                User.id, User.username, User.email, User.created_at, User.last_login
+            )])
+            if user is not None:
+                cache_user(user)
+        g._user = user
+    return user
+
 class CurrentUser:
     def __init__(self, user_id=None):
         self.user_id = user_id
@@ -419,7 +871,7 @@ class CurrentUser:
     @property
     def user(self):
         if self.user_id and not self._user:
-            self._user = User.query.get(self.user_id)
+            self._user = load_request_user(self.user_id)
         return self._user
     
     @property
@@ -436,24 +888,40 @@ class CurrentUser:
     
     @property
     def last_login(self):
-        return self.user.last_login if self.user else None
+        last_login = self.user.last_login if self.user else None
+        # This session's own login reaches the database a moment after the redirect
+        login_time = session.get('login_time') if self.user_id else None
+        if login_time is not None:
+            logged_in_at = datetime.utcfromtimestamp(login_time)
+            if last_login is None or logged_in_at > last_login:
+                return logged_in_at
+        return last_login
 
 def get_current_user():
-    user_id = session.get('user_id')
+    """Return the request's CurrentUser, built once unless login or logout changes the session"""
+    user_id = session.get('user_id') or None
+    current_user = g.get('_current_user')
+    if current_user is None or current_user.user_id != user_id:
+        current_user = g._current_user = _load_current_user(user_id)
+    return current_user
+
+def _load_current_user(user_id):
     if not user_id:
         return CurrentUser(None)
     
     # Validate that the user still exists in the database
     try:
-        user_exists = User.query.get(user_id) is not None
+        user_exists = load_request_user(user_id) is not None
         if not user_exists:
             # User was deleted from database, clear session
             session.clear()
+            g.session_valid = False
             return CurrentUser(None)
     except Exception as e:
         print(f"Error validating user in database: {e}")
         # If database query fails, clear session to be safe
         session.clear()
+        g.session_valid = False
         return CurrentUser(None)
     
     return CurrentUser(user_id)
@@ -461,9 +929,9 @@ def get_current_user():
 # Routes
 @app.route('/')
 def index():
-    if 'user_id' in session and SessionManager.is_session_valid():
+    if g.session_valid:
         return redirect(url_for('dashboard'))
-    return render_template("./index.html")
+    return render_template("index.html")
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -476,7 +944,19 @@ def register():
             )
             user.set_password(form.password.data)
             
-            db.session.add(user)
+            # One round-trip: the unique constraints do the duplicate check
+            user_id = db.session.execute(
+                insert_ignoring_conflicts(User).values(
+                    username=user.username,
+                    email=user.email,
+                    password_hash=user.password_hash
+                ).returning(User.id)
+            ).scalar()
+            
+            if user_id is None:
+                form.add_conflict_errors()
+                return render_template('register.html', form=form)
+            
             db.session.commit()
             
             flash('Registration successful! You can now sign in.', 'success')
@@ -497,16 +977,28 @@ def register():
     
     return render_template('register.html', form=form)
 
+def _login_rate_key():
+    """Count login attempts per client and attempted account"""
+    return f"login:{get_client_ip()}:{request.form.get('username', '').strip().lower()}"
+
 @app.route('/login', methods=['GET', 'POST'])
+@rate_limit(max_requests=5, window_seconds=60, key_func=_login_rate_key, methods=('POST',))
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = get_user_by_username_or_email(form.username.data)
+        with db.session.no_autoflush:
+            user = get_user_by_username_or_email(form.username.data)
+            if user is None:
+                verify_dummy_password(form.password.data)
+                authenticated = False
+            else:
+                authenticated = user.check_password(form.password.data)
         
-        if user and user.check_password(form.password.data):
+        if authenticated:
             if user.is_active:
                 SessionManager.create_session(user.id, form.remember_me.data)
-                user.last_login = datetime.utcnow()
+                last_login_writer.record(user.id, datetime.utcnow())
+                # Persists a password hash upgraded by check_password
                 db.session.commit()
                 
                 flash('Login successful!', 'success')
@@ -521,30 +1013,32 @@ def login():
     return render_template('login.html', form=form)
 
 @app.route('/courses')
+@without_autoflush
 def courses():
     """Course catalog page"""
     current_user = get_current_user()
-    courses = Course.query.filter_by(is_active=True).all()
+    courses = get_active_courses()
     return render_template('courses.html', courses=courses, current_user=current_user)
 
 @app.route('/course/<int:course_id>')
+@without_autoflush
 def course_detail(course_id):
     """Course detail page"""
     current_user = get_current_user()
-    course = Course.query.get_or_404(course_id)
-    
-    # Get course modules with lessons
-    modules = Module.query.filter_by(course_id=course_id).order_by(Module.order_index).all()
+    # Modules come back ordered, each with its ordered lessons
+    course = Course.query.options(
+        selectinload(Course.modules).selectinload(Module.lessons)
+    ).filter_by(id=course_id).first_or_404()
+    modules = course.modules
     
     # Check if user is enrolled
     is_enrolled = False
     if current_user.is_authenticated and current_user.user:
-        enrollment = Enrollment.query.filter_by(
+        is_enrolled = db.session.query(Enrollment.query.filter_by(
             user_id=current_user.user.id, 
             course_id=course_id, 
             is_active=True
-        ).first()
-        is_enrolled = enrollment is not None
+        ).exists()).scalar()
     
     return render_template('course_detail.html', 
                          course=course, 
@@ -575,39 +1069,45 @@ def enroll_request():
         db.session.rollback()
         return jsonify({'success': False, 'message': 'حدث خطأ أثناء إرسال الطلب'}), 500
 
-def calculate_course_progress(enrollment_id):
-    """Calculate and update course progress percentage"""
-    enrollment = Enrollment.query.get(enrollment_id)
-    if not enrollment:
-        return 0
+def count_course_lessons(course_id, enrollment_id):
+    """Return (total_lessons, completed_lessons) for an enrollment in one aggregate query"""
+    return db.session.execute(
+        select(
+            # Distinct, so duplicate progress rows on older databases cannot inflate either count
+            db.func.count(db.distinct(Lesson.id)),
+            db.func.count(db.distinct(db.case((LessonProgress.is_completed == True, Lesson.id))))
+        ).select_from(Lesson).join(
+            Module, Lesson.module_id == Module.id
+        ).outerjoin(
+            LessonProgress,
+            db.and_(
+                LessonProgress.lesson_id == Lesson.id,
+                LessonProgress.enrollment_id == enrollment_id
+            )
+        ).where(Module.course_id == course_id)
+    ).one()
+
+def calculate_course_progress(enrollment):
+    """Update an enrollment's progress percentage (caller commits).
     
-    # Get total lessons in the course
-    total_lessons = db.session.query(Lesson).join(
-        Module, Lesson.module_id == Module.id
-    ).filter(Module.course_id == enrollment.course_id).count()
+    Returns a (total_lessons, completed_lessons) tuple.
+    """
+    total_lessons, completed_lessons = count_course_lessons(enrollment.course_id, enrollment.id)
     
     if total_lessons == 0:
-        return 0
-    
-    # Get completed lessons for this enrollment
-    completed_lessons = LessonProgress.query.filter_by(
-        enrollment_id=enrollment_id,
-        is_completed=True
-    ).count()
-    
-    # Calculate percentage
-    progress_percentage = (completed_lessons / total_lessons) * 100
+        return total_lessons, completed_lessons
     
     # Update enrollment progress
+    progress_percentage = (completed_lessons / total_lessons) * 100
     enrollment.progress_percentage = round(progress_percentage, 2)
     enrollment.last_accessed = datetime.utcnow()
-    db.session.commit()
     
-    return progress_percentage
+    return total_lessons, completed_lessons
 
 @app.route('/dashboard')
+@without_autoflush
 def dashboard():
-    if 'user_id' not in session or not SessionManager.is_session_valid():
+    if not g.session_valid:
         flash('Please log in to access the dashboard.', 'error')
         return redirect(url_for('login'))
     
@@ -624,25 +1124,17 @@ def dashboard():
     available_courses = []
     
     try:
-        enrollments_data = db.session.query(Enrollment, Course).join(Course).filter(
+        enrollments = Enrollment.query.options(
+            selectinload(Enrollment.course).options(_course_card_columns)
+        ).filter(
             Enrollment.user_id == current_user.user.id,
             Enrollment.is_active == True
         ).all()
         
         # Update progress for each enrollment and prepare data
-        for enrollment, course in enrollments_data:
-            # Calculate current progress
-            calculate_course_progress(enrollment.id)
-            
-            # Get lesson count and completed count for display
-            total_lessons = db.session.query(Lesson).join(
-                Module, Lesson.module_id == Module.id
-            ).filter(Module.course_id == course.id).count()
-            
-            completed_lessons = LessonProgress.query.filter_by(
-                enrollment_id=enrollment.id,
-                is_completed=True
-            ).count()
+        for enrollment in enrollments:
+            # Calculate current progress and keep the counts for display
+            total_lessons, completed_lessons = calculate_course_progress(enrollment)
             
             # Add additional info to enrollment object
             enrollment.total_lessons = total_lessons
@@ -661,19 +1153,25 @@ def dashboard():
                         LessonProgress.is_completed == True
                     )
                 ).filter(
-                    Module.course_id == course.id,
+                    Module.course_id == enrollment.course_id,
                     LessonProgress.id.is_(None)
                 ).order_by(Module.order_index, Lesson.order_index).first()
                 
                 enrollment.next_lesson = next_lesson
-            
-            enrollments.append((enrollment, course))
         
-        # Get available courses (not enrolled)
-        enrolled_course_ids = [enrollment.course_id for enrollment, _ in enrollments]
-        available_courses = Course.query.filter(
+        db.session.commit()
+        
+        # Get available courses (not enrolled) with an anti-join
+        available_courses = Course.query.options(_course_card_columns).outerjoin(
+            Enrollment,
+            db.and_(
+                Enrollment.course_id == Course.id,
+                Enrollment.user_id == current_user.user.id,
+                Enrollment.is_active == True
+            )
+        ).filter(
             Course.is_active == True,
-            ~Course.id.in_(enrolled_course_ids) if enrolled_course_ids else True
+            Enrollment.id.is_(None)
         ).limit(6).all()
         
     except Exception as e:
@@ -696,7 +1194,8 @@ def dashboard():
 def forgot_password():
     form = ForgotPasswordForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(email=form.email.data.lower() if form.email.data else '').first()
+        email = form.email.data.lower() if form.email.data else ''
+        user = db.session.execute(_user_by_email, {'email': email}).scalar_one_or_none()
         
         if user:
             token = user.generate_reset_token()
@@ -716,7 +1215,9 @@ def forgot_password():
 
 @app.route('/reset-password/<token>', methods=['GET', 'POST'])
 def reset_password(token):
-    user = User.query.filter_by(reset_token=token).first()
+    user = db.session.execute(
+        _user_by_reset_token, {'token': hash_reset_token(token)}
+    ).scalar_one_or_none()
     
     if not user or not user.verify_reset_token(token):
         flash('Invalid or expired reset token.', 'error')
@@ -751,11 +1252,33 @@ def internal_error(error):
     return render_template('500.html'), 500
 
 # Database initialization
+# Names of model indexes known to exist, filled in by create_missing_indexes
+present_indexes = set()
+
+def create_missing_indexes():
+    """
+    Create indexes added to models after their tables already existed
+    
+    Each index gets its own transaction so one failure does not keep the others
+    from being created. A unique index fails on a table that already holds
+    duplicate rows; remove the duplicates by hand and restart to create it.
+    """
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+            except SQLAlchemyError as e:
+                print(f"Error creating index {index.name} on {table.name}: {e}")
+            else:
+                present_indexes.add(index.name)
+
 def init_db():
     """Initialize database tables"""
     try:
         with app.app_context():
             db.create_all()
+            create_missing_indexes()
             print("Database tables created successfully!")
             
             # Add fake course data if no courses exist
@@ -769,13 +1292,29 @@ def init_db():
         print(f"Error initializing database: {e}")
         # Don't raise the exception to prevent app from crashing
 
+def preload_templates():
+    """Compile all app templates up front so no request pays the compile cost"""
+    for name in app.jinja_loader.list_templates():
+        if name.endswith('.html'):
+            app.jinja_env.get_template(name)
+
 # Initialize database on app startup (for production)
 with app.app_context():
     try:
         db.create_all()
+        create_missing_indexes()
         print("Database tables created on startup!")
     except Exception as e:
         print(f"Error creating tables on startup: {e}")
+    
+    preload_templates()
+
+# The lesson page is the hottest view; in production keep its compiled template at hand.
+# Development goes through render_template so template edits reload and signals fire.
+if os.environ.get('FLASK_ENV') == 'production':
+    _lesson_player_template = app.jinja_env.get_template('lesson_player.html')
+else:
+    _lesson_player_template = None
 
 def add_fake_courses():
     """Add fake course data for testing and demonstration"""
@@ -850,41 +1389,42 @@ def add_fake_courses():
     )
     
     db.session.add_all([course1, course2, course3])
+    db.session.flush()
+    
+    # Gather every course's modules and lessons so each table gets a single executemany
+    module_rows = []
+    lesson_groups = []
+    for course in (course1, course2, course3):
+        for module_row, lesson_rows in course_modules_lessons(course.category):
+            module_rows.append(dict(module_row, course_id=course.id))
+            lesson_groups.append(lesson_rows)
+    
+    module_ids = db.session.scalars(
+        insert(Module).returning(Module.id, sort_by_parameter_order=True), module_rows
+    ).all()
+    db.session.execute(insert(Lesson), [
+        dict(lesson_row, module_id=module_id)
+        for module_id, lesson_rows in zip(module_ids, lesson_groups)
+        for lesson_row in lesson_rows
+    ])
     db.session.commit()
     
-    # Add modules and lessons for Course 1 (Web Development)
-    add_course_modules_lessons(course1.id, "web-development")
-    add_course_modules_lessons(course2.id, "mobile-development")
-    add_course_modules_lessons(course3.id, "data-science")
-    
     print("Fake course data added successfully!")
 
 def add_test_users():
     """Add test users for development and testing"""
     
-    # Test User 1: Regular student
-    user1 = User(
-        username="student1",
-        email="student1@test.com"
-    )
-    user1.set_password("password123")
-    
-    # Test User 2: Another student
-    user2 = User(
-        username="ahmed_test",
-        email="ahmed@test.com"
-    )
-    user2.set_password("password123")
-    
-    # Test User 3: Admin/Instructor
-    user3 = User(
-        username="instructor",
-        email="instructor@test.com"
-    )
-    user3.set_password("password123")
+    user1, user2, user3 = User.bulk_create([
+        # Test User 1: Regular student
+        ("student1", "student1@test.com", "password123"),
+        # Test User 2: Another student
+        ("ahmed_test", "ahmed@test.com", "password123"),
+        # Test User 3: Admin/Instructor
+        ("instructor", "instructor@test.com", "password123"),
+    ])
     
     db.session.add_all([user1, user2, user3])
-    db.session.commit()
+    db.session.flush()
     
     # Add some test enrollments
     course1 = Course.query.filter_by(category="web-development").first()
@@ -915,7 +1455,8 @@ def add_test_users():
         )
         
         db.session.add_all([enrollment1, enrollment2, enrollment3])
-        db.session.commit()
+    
+    db.session.commit()
     
     print("Test users created successfully!")
     print("Test Users:")
@@ -923,13 +1464,12 @@ def add_test_users():
     print("2. Username: ahmed_test, Email: ahmed@test.com, Password: password123")
     print("3. Username: instructor, Email: instructor@test.com, Password: password123")
 
-def add_course_modules_lessons(course_id, course_type):
-    """Add modules and lessons for a specific course"""
+def course_modules_lessons(course_type):
+    """Seed rows for a course type's modules, as (module row, lesson rows) pairs"""
     
     if course_type == "web-development":
         # Module 1: HTML & CSS
-        module1 = Module(
-            course_id=course_id,
+        module1 = dict(
             title_ar="أساسيات HTML و CSS",
             title_en="HTML & CSS Fundamentals",
             description_ar="تعلم أساسيات بناء صفحات الويب",
@@ -938,8 +1478,7 @@ def add_course_modules_lessons(course_id, course_type):
         )
         
         # Module 2: JavaScript
-        module2 = Module(
-            course_id=course_id,
+        module2 = dict(
             title_ar="JavaScript المتقدم",
             title_en="Advanced JavaScript",
             description_ar="تعلم البرمجة التفاعلية للمواقع",
@@ -948,8 +1487,7 @@ def add_course_modules_lessons(course_id, course_type):
         )
         
         # Module 3: React
-        module3 = Module(
-            course_id=course_id,
+        module3 = dict(
             title_ar="React.js للمبتدئين",
             title_en="React.js for Beginners",
             description_ar="بناء واجهات تفاعلية حديثة",
@@ -957,48 +1495,44 @@ def add_course_modules_lessons(course_id, course_type):
             order_index=3
         )
         
-        db.session.add_all([module1, module2, module3])
-        db.session.commit()
-        
         # Add lessons for Module 1
         lessons_module1 = [
-            Lesson(module_id=module1.id, title_ar="مقدمة في HTML", title_en="Introduction to HTML", 
-                  content_ar="تعلم أساسيات HTML", content_en="Learn HTML basics",
-                  duration_minutes=30, order_index=1, is_free=True),
-            Lesson(module_id=module1.id, title_ar="تنسيق النصوص", title_en="Text Formatting", 
-                  content_ar="تنسيق النصوص في HTML", content_en="Text formatting in HTML",
-                  duration_minutes=25, order_index=2, is_free=False),
-            Lesson(module_id=module1.id, title_ar="أساسيات CSS", title_en="CSS Basics", 
-                  content_ar="تعلم تنسيق الصفحات", content_en="Learn page styling",
-                  duration_minutes=35, order_index=3, is_free=False)
+            dict(title_ar="مقدمة في HTML", title_en="Introduction to HTML", 
+                 content_ar="تعلم أساسيات HTML", content_en="Learn HTML basics",
+                 duration_minutes=30, order_index=1, is_free=True),
+            dict(title_ar="تنسيق النصوص", title_en="Text Formatting", 
+                 content_ar="تنسيق النصوص في HTML", content_en="Text formatting in HTML",
+                 duration_minutes=25, order_index=2, is_free=False),
+            dict(title_ar="أساسيات CSS", title_en="CSS Basics", 
+                 content_ar="تعلم تنسيق الصفحات", content_en="Learn page styling",
+                 duration_minutes=35, order_index=3, is_free=False)
         ]
         
         # Add lessons for Module 2
         lessons_module2 = [
-            Lesson(module_id=module2.id, title_ar="متغيرات JavaScript", title_en="JavaScript Variables", 
-                  content_ar="تعلم المتغيرات والأنواع", content_en="Learn variables and types",
-                  duration_minutes=40, order_index=1, is_free=True),
-            Lesson(module_id=module2.id, title_ar="الدوال والكائنات", title_en="Functions and Objects", 
-                  content_ar="البرمجة الكائنية في JavaScript", content_en="Object-oriented programming in JavaScript",
-                  duration_minutes=45, order_index=2, is_free=False)
+            dict(title_ar="متغيرات JavaScript", title_en="JavaScript Variables", 
+                 content_ar="تعلم المتغيرات والأنواع", content_en="Learn variables and types",
+                 duration_minutes=40, order_index=1, is_free=True),
+            dict(title_ar="الدوال والكائنات", title_en="Functions and Objects", 
+                 content_ar="البرمجة الكائنية في JavaScript", content_en="Object-oriented programming in JavaScript",
+                 duration_minutes=45, order_index=2, is_free=False)
         ]
         
         # Add lessons for Module 3
         lessons_module3 = [
-            Lesson(module_id=module3.id, title_ar="مقدمة في React", title_en="Introduction to React", 
-                  content_ar="أساسيات مكتبة React", content_en="React library fundamentals",
-                  duration_minutes=50, order_index=1, is_free=False),
-            Lesson(module_id=module3.id, title_ar="المكونات والخصائص", title_en="Components and Props", 
-                  content_ar="بناء المكونات القابلة لإعادة الاستخدام", content_en="Building reusable components",
-                  duration_minutes=55, order_index=2, is_free=False)
+            dict(title_ar="مقدمة في React", title_en="Introduction to React", 
+                 content_ar="أساسيات مكتبة React", content_en="React library fundamentals",
+                 duration_minutes=50, order_index=1, is_free=False),
+            dict(title_ar="المكونات والخصائص", title_en="Components and Props", 
+                 content_ar="بناء المكونات القابلة لإعادة الاستخدام", content_en="Building reusable components",
+                 duration_minutes=55, order_index=2, is_free=False)
         ]
         
-        db.session.add_all(lessons_module1 + lessons_module2 + lessons_module3)
+        return [(module1, lessons_module1), (module2, lessons_module2), (module3, lessons_module3)]
         
     elif course_type == "mobile-development":
         # Add modules for mobile development course
-        module1 = Module(
-            course_id=course_id,
+        module1 = dict(
             title_ar="أساسيات React Native",
             title_en="React Native Fundamentals",
             description_ar="تعلم أساسيات تطوير التطبيقات",
@@ -1006,8 +1540,7 @@ def add_course_modules_lessons(course_id, course_type):
             order_index=1
         )
         
-        module2 = Module(
-            course_id=course_id,
+        module2 = dict(
             title_ar="واجهات المستخدم",
             title_en="User Interfaces",
             description_ar="تصميم واجهات جذابة",
@@ -1015,28 +1548,26 @@ def add_course_modules_lessons(course_id, course_type):
             order_index=2
         )
         
-        db.session.add_all([module1, module2])
-        db.session.commit()
-        
         # Add lessons
-        lessons = [
-            Lesson(module_id=module1.id, title_ar="إعداد البيئة", title_en="Environment Setup", 
-                  content_ar="تحضير بيئة التطوير", content_en="Prepare development environment",
-                  duration_minutes=30, order_index=1, is_free=True),
-            Lesson(module_id=module1.id, title_ar="أول تطبيق", title_en="First App", 
-                  content_ar="بناء أول تطبيق محمول", content_en="Build first mobile app",
-                  duration_minutes=45, order_index=2, is_free=False),
-            Lesson(module_id=module2.id, title_ar="التنقل بين الشاشات", title_en="Screen Navigation", 
-                  content_ar="إدارة التنقل في التطبيق", content_en="Manage app navigation",
-                  duration_minutes=40, order_index=1, is_free=False)
+        lessons_module1 = [
+            dict(title_ar="إعداد البيئة", title_en="Environment Setup", 
+                 content_ar="تحضير بيئة التطوير", content_en="Prepare development environment",
+                 duration_minutes=30, order_index=1, is_free=True),
+            dict(title_ar="أول تطبيق", title_en="First App", 
+                 content_ar="بناء أول تطبيق محمول", content_en="Build first mobile app",
+                 duration_minutes=45, order_index=2, is_free=False)
+        ]
+        lessons_module2 = [
+            dict(title_ar="التنقل بين الشاشات", title_en="Screen Navigation", 
+                 content_ar="إدارة التنقل في التطبيق", content_en="Manage app navigation",
+                 duration_minutes=40, order_index=1, is_free=False)
         ]
         
-        db.session.add_all(lessons)
+        return [(module1, lessons_module1), (module2, lessons_module2)]
         
     elif course_type == "data-science":
         # Add modules for data science course
-        module1 = Module(
-            course_id=course_id,
+        module1 = dict(
             title_ar="Python للبيانات",
             title_en="Python for Data",
             description_ar="استخدام Python في تحليل البيانات",
@@ -1044,8 +1575,7 @@ def add_course_modules_lessons(course_id, course_type):
             order_index=1
         )
         
-        module2 = Module(
-            course_id=course_id,
+        module2 = dict(
             title_ar="التعلم الآلي",
             title_en="Machine Learning",
             description_ar="خوارزميات التعلم الآلي",
@@ -1053,33 +1583,40 @@ def add_course_modules_lessons(course_id, course_type):
             order_index=2
         )
         
-        db.session.add_all([module1, module2])
-        db.session.commit()
-        
         # Add lessons
-        lessons = [
-            Lesson(module_id=module1.id, title_ar="مكتبة Pandas", title_en="Pandas Library", 
-                  content_ar="تحليل البيانات باستخدام Pandas", content_en="Data analysis using Pandas",
-                  duration_minutes=60, order_index=1, is_free=True),
-            Lesson(module_id=module1.id, title_ar="التصور البياني", title_en="Data Visualization", 
-                  content_ar="رسم البيانات والمخططات", content_en="Data plotting and charts",
-                  duration_minutes=50, order_index=2, is_free=False),
-            Lesson(module_id=module2.id, title_ar="الشبكات العصبية", title_en="Neural Networks", 
-                  content_ar="مقدمة في الشبكات العصبية", content_en="Introduction to neural networks",
-                  duration_minutes=70, order_index=1, is_free=False)
+        lessons_module1 = [
+            dict(title_ar="مكتبة Pandas", title_en="Pandas Library", 
+                 content_ar="تحليل البيانات باستخدام Pandas", content_en="Data analysis using Pandas",
+                 duration_minutes=60, order_index=1, is_free=True),
+            dict(title_ar="التصور البياني", title_en="Data Visualization", 
+                 content_ar="رسم البيانات والمخططات", content_en="Data plotting and charts",
+                 duration_minutes=50, order_index=2, is_free=False)
+        ]
+        lessons_module2 = [
+            dict(title_ar="الشبكات العصبية", title_en="Neural Networks", 
+                 content_ar="مقدمة في الشبكات العصبية", content_en="Introduction to neural networks",
+                 duration_minutes=70, order_index=1, is_free=False)
         ]
         
-        db.session.add_all(lessons)
+        return [(module1, lessons_module1), (module2, lessons_module2)]
     
-    db.session.commit()
+    return []
 
 @app.route('/lesson/<int:lesson_id>')
+@without_autoflush
 def lesson_player(lesson_id):
-    lesson = Lesson.query.get_or_404(lesson_id)
-    course = Course.query.get_or_404(lesson.module.course_id)
+    # Module and course arrive joined; the module's lessons follow in one selectin query
+    lesson = db.one_or_404(
+        select(Lesson).options(
+            joinedload(Lesson.module).joinedload(Module.course),
+            joinedload(Lesson.module).selectinload(Module.lessons)
+        ).where(Lesson.id == lesson_id)
+    )
+    course = lesson.module.course
     
     # Check if user is logged in
-    if 'user_id' not in session or not SessionManager.is_session_valid():
+    lesson_progress = None
+    if not g.session_valid:
         # Allow free preview for free lessons only
         if not lesson.is_free:
             flash('يجب تسجيل الدخول لمشاهدة هذا الدرس.', 'error')
@@ -1088,15 +1625,25 @@ def lesson_player(lesson_id):
         current_user = None
     else:
         current_user = get_current_user()
-        # Check if user is enrolled in the course
+        # Check enrollment and fetch this lesson's progress in one query
         user_enrolled = False
         if current_user.user:
-            enrollment = Enrollment.query.filter_by(
-                user_id=current_user.user.id,
-                course_id=course.id,
-                is_active=True
+            row = db.session.execute(
+                select(Enrollment.id, LessonProgress).outerjoin(
+                    LessonProgress,
+                    db.and_(
+                        LessonProgress.enrollment_id == Enrollment.id,
+                        LessonProgress.lesson_id == lesson_id
+                    )
+                ).where(
+                    Enrollment.user_id == current_user.user.id,
+                    Enrollment.course_id == course.id,
+                    Enrollment.is_active == True
+                ).limit(1)
             ).first()
-            user_enrolled = enrollment is not None
+            user_enrolled = row is not None
+            if row is not None:
+                lesson_progress = row.LessonProgress
     
     # Determine if user can access this lesson
     can_access = lesson.is_free or user_enrolled
@@ -1105,88 +1652,97 @@ def lesson_player(lesson_id):
         flash('يجب التسجيل في الدورة لمشاهدة هذا الدرس.', 'error')
         return redirect(url_for('course_detail', course_id=course.id))
     
-    # Get all lessons in the module for navigation
-    module_lessons = Lesson.query.filter_by(module_id=lesson.module_id).order_by(Lesson.order_index).all()
+    # Lessons in the module for navigation, already loaded by the selectinload above
+    module_lessons = lesson.module.lessons
+    
+    context = dict(lesson=lesson,
+                   course=course,
+                   module_lessons=module_lessons,
+                   user_enrolled=user_enrolled,
+                   current_user=current_user,
+                   lesson_progress=lesson_progress,
+                   can_access=can_access)
+    if _lesson_player_template is not None:
+        return _lesson_player_template.render(**context)
+    return render_template('lesson_player.html', **context)
+
+def record_lesson_completion(enrollment_id, lesson_id):
+    """Mark a lesson completed for an enrollment, creating its progress row if needed"""
+    completed_at = datetime.utcnow()
+    
+    # ON CONFLICT needs the unique index, which an older database may still lack
+    if 'ix_lesson_progress_enrollment_lesson' in present_indexes:
+        db.session.execute(upsert(
+            LessonProgress,
+            dict(
+                enrollment_id=enrollment_id,
+                lesson_id=lesson_id,
+                is_completed=True,
+                completed_at=completed_at,
+                watch_time_seconds=0
+            ),
+            index_elements=['enrollment_id', 'lesson_id'],
+            update_columns=['is_completed', 'completed_at']
+        ))
+        return
     
-    # Get user's progress for this lesson if enrolled
-    lesson_progress = None
-    if user_enrolled and current_user and current_user.user:
-        enrollment = Enrollment.query.filter_by(
-            user_id=current_user.user.id,
-            course_id=course.id,
-            is_active=True
-        ).first()
-        if enrollment:
-            lesson_progress = LessonProgress.query.filter_by(
-                enrollment_id=enrollment.id,
-                lesson_id=lesson_id
-            ).first()
+    lesson_progress = LessonProgress.query.filter_by(
+        enrollment_id=enrollment_id,
+        lesson_id=lesson_id
+    ).first()
     
-    return render_template('lesson_player.html',
-                         lesson=lesson,
-                         course=course,
-                         module_lessons=module_lessons,
-                         user_enrolled=user_enrolled,
-                         current_user=current_user,
-                         lesson_progress=lesson_progress,
-                         can_access=can_access)
+    if not lesson_progress:
+        db.session.add(LessonProgress(
+            enrollment_id=enrollment_id,
+            lesson_id=lesson_id,
+            is_completed=True,
+            completed_at=completed_at
+        ))
+    else:
+        lesson_progress.is_completed = True
+        lesson_progress.completed_at = completed_at
 
 @app.route('/lesson/<int:lesson_id>/complete', methods=['POST'])
 def complete_lesson(lesson_id):
-    if 'user_id' not in session or not SessionManager.is_session_valid():
+    if not g.session_valid:
         return jsonify({'success': False, 'message': 'يجب تسجيل الدخول أولاً'})
     
     current_user = get_current_user()
     if not current_user.user:
         return jsonify({'success': False, 'message': 'خطأ في المصادقة'})
     
-    lesson = Lesson.query.get_or_404(lesson_id)
-    course = Course.query.get_or_404(lesson.module.course_id)
+    lesson = db.one_or_404(
+        select(Lesson).options(joinedload(Lesson.module)).where(Lesson.id == lesson_id)
+    )
+    course = db.get_or_404(Course, lesson.module.course_id)
     
-    # Check if user is enrolled
-    enrollment = Enrollment.query.filter_by(
-        user_id=current_user.user.id,
-        course_id=course.id,
-        is_active=True
+    # Check if user is enrolled; the row stays locked until commit so concurrent
+    # completions recompute progress one after another
+    enrollment = db.session.scalars(
+        select(Enrollment).where(
+            Enrollment.user_id == current_user.user.id,
+            Enrollment.course_id == course.id,
+            Enrollment.is_active == True
+        ).limit(1).with_for_update()
     ).first()
     
     if not enrollment:
         return jsonify({'success': False, 'message': 'يجب التسجيل في الدورة أولاً'})
     
-    # Create or update lesson progress
-    lesson_progress = LessonProgress.query.filter_by(
-        enrollment_id=enrollment.id,
-        lesson_id=lesson_id
-    ).first()
-    
-    if not lesson_progress:
-        lesson_progress = LessonProgress(
-            enrollment_id=enrollment.id,
-            lesson_id=lesson_id,
-            is_completed=True,
-            completed_at=datetime.utcnow()
-        )
-        db.session.add(lesson_progress)
-    else:
-        lesson_progress.is_completed = True
-        lesson_progress.completed_at = datetime.utcnow()
-    
-    # Update enrollment progress
-    total_lessons = db.session.query(Lesson).join(Module).filter(Module.course_id == course.id).count()
-    completed_lessons = db.session.query(LessonProgress).join(Lesson).join(Module).filter(
-        Module.course_id == course.id,
-        LessonProgress.enrollment_id == enrollment.id,
-        LessonProgress.is_completed == True
-    ).count()
-    
-    enrollment.progress_percentage = int((completed_lessons / total_lessons) * 100) if total_lessons > 0 else 0
-    
     try:
+        record_lesson_completion(enrollment.id, lesson_id)
+        
+        # Update enrollment progress
+        total_lessons, completed_lessons = count_course_lessons(course.id, enrollment.id)
+        
+        enrollment.progress_percentage = int((completed_lessons / total_lessons) * 100) if total_lessons > 0 else 0
+        
         db.session.commit()
+        invalidate_dashboard_cache(current_user.user_id)
         return jsonify({
             'success': True, 
             'message': 'تم إكمال الدرس بنجاح!',
-            'progress': enrollment.progress_percentage
+            'progress': float(enrollment.progress_percentage)
         })
     except Exception as e:
         db.session.rollback()
@@ -1,19 +1,86 @@
 """
 Security utilities for Flask authentication system
 """
+import logging
+import os
+import queue
+import threading
 import time
-from collections import defaultdict, deque
+from collections import OrderedDict
 from functools import wraps
-from flask import request, jsonify, session, current_app, redirect, url_for
-import hashlib
+from flask import request, jsonify, session, current_app, redirect, url_for, g
 import hmac
+import re
+import secrets
+
+NS_PER_SECOND = 1_000_000_000
 
 class RateLimiter:
-    """Simple in-memory rate limiter"""
+    """Simple in-memory rate limiter (sliding window over two fixed buckets)"""
+    
+    # Atomically: report a block, or count this request and read the previous bucket
+    _REDIS_SCRIPT = """
+    if redis.call('EXISTS', KEYS[3]) == 1 then
+        return {-1, 0}
+    end
+    local current = redis.call('INCR', KEYS[1])
+    if current == 1 then
+        redis.call('PEXPIRE', KEYS[1], ARGV[1])
+    end
+    return {current, tonumber(redis.call('GET', KEYS[2]) or '0')}
+    """
     
-    def __init__(self):
-        self.requests = defaultdict(deque)
-        self.blocked_ips = defaultdict(float)
+    def __init__(self, max_entries=100000):
+        # identifier -> [bucket number, requests in that bucket, requests in the one before]
+        # Both maps are LRU-bounded so a spray of distinct identifiers cannot grow them forever
+        self.max_entries = max_entries
+        self.buckets = OrderedDict()
+        self.blocked_ips = OrderedDict()
+        self._lock = threading.Lock()
+        self.redis = None
+    
+    def use_redis(self, client):
+        """Keep counters in Redis so every worker shares them; the in-memory path stays as fallback"""
+        import redis
+        self.redis = client
+        self._redis_errors = redis.RedisError
+        self._redis_script = client.register_script(self._REDIS_SCRIPT)
+    
+    def _redis_is_allowed(self, identifier, max_requests, window_seconds, block_duration):
+        current_time = time.time()
+        bucket = int(current_time // window_seconds)
+        keys = [f'ratelimit:{identifier}:{bucket}', f'ratelimit:{identifier}:{bucket - 1}',
+                f'ratelimit:block:{identifier}']
+        current, previous = self._redis_script(keys=keys, args=[window_seconds * 2000])
+        if current < 0:
+            return False
+        
+        elapsed = (current_time % window_seconds) / window_seconds
+        if current - 1 + previous * (1 - elapsed) >= max_requests:
+            self.redis.set(keys[2], 1, px=block_duration * 1000)
+            return False
+        return True
+    
+    def _remember(self, entries, identifier, value):
+        """Store value as the most recently used entry, evicting the least recently used overflow"""
+        entries[identifier] = value
+        entries.move_to_end(identifier)
+        if len(entries) > self.max_entries:
+            entries.popitem(last=False)
+    
+    def _window(self, identifier, current_time, window_ns):
+        """Rotate identifier's buckets to now and return them with the weighted request count"""
+        bucket = current_time // window_ns
+        state = self.buckets.get(identifier)
+        if state is None or state[0] < bucket - 1:
+            state = [bucket, 0, 0]
+        elif state[0] == bucket - 1:
+            state = [bucket, 0, state[1]]
+        self._remember(self.buckets, identifier, state)
+        
+        # The previous bucket counts for the part of it still inside the window
+        elapsed = (current_time % window_ns) / window_ns
+        return state, state[1] + state[2] * (1 - elapsed)
     
     def is_allowed(self, identifier, max_requests=5, window_seconds=300, block_duration=900):
         """
@@ -25,46 +92,58 @@ class RateLimiter:
             window_seconds: Time window in seconds (default: 5 minutes)
             block_duration: Block duration in seconds (default: 15 minutes)
         """
-        current_time = time.time()
-        
-        # Check if IP is currently blocked
-        if identifier in self.blocked_ips:
-            if current_time < self.blocked_ips[identifier]:
-                return False
-            else:
-                # Unblock IP
-                del self.blocked_ips[identifier]
-        
-        # Clean old requests
-        request_times = self.requests[identifier]
-        while request_times and request_times[0] < current_time - window_seconds:
-            request_times.popleft()
+        if self.redis is not None:
+            try:
+                return self._redis_is_allowed(identifier, max_requests, window_seconds, block_duration)
+            except self._redis_errors:
+                pass
         
-        # Check if limit exceeded
-        if len(request_times) >= max_requests:
-            # Block IP
-            self.blocked_ips[identifier] = current_time + block_duration
-            return False
+        # Integer nanoseconds on a clock that cannot jump when the wall clock is reset
+        current_time = time.monotonic_ns()
         
-        # Add current request
-        request_times.append(current_time)
-        return True
+        with self._lock:
+            # Check if IP is currently blocked
+            if identifier in self.blocked_ips:
+                if current_time < self.blocked_ips[identifier]:
+                    return False
+                else:
+                    # Unblock IP
+                    del self.blocked_ips[identifier]
+            
+            state, count = self._window(identifier, current_time, window_seconds * NS_PER_SECOND)
+            
+            # Check if limit exceeded
+            if count >= max_requests:
+                # Block IP
+                self._remember(self.blocked_ips, identifier, current_time + block_duration * NS_PER_SECOND)
+                return False
+            
+            # Add current request
+            state[1] += 1
+            return True
     
     def get_remaining_requests(self, identifier, max_requests=5, window_seconds=300):
         """Get remaining requests for identifier"""
-        current_time = time.time()
-        request_times = self.requests[identifier]
+        if self.redis is not None:
+            try:
+                current_time = time.time()
+                bucket = int(current_time // window_seconds)
+                current, previous = (int(n or 0) for n in self.redis.mget(
+                    f'ratelimit:{identifier}:{bucket}', f'ratelimit:{identifier}:{bucket - 1}'
+                ))
+                elapsed = (current_time % window_seconds) / window_seconds
+                return max(0, int(max_requests - current - previous * (1 - elapsed)))
+            except self._redis_errors:
+                pass
         
-        # Clean old requests
-        while request_times and request_times[0] < current_time - window_seconds:
-            request_times.popleft()
-        
-        return max(0, max_requests - len(request_times))
+        with self._lock:
+            _, count = self._window(identifier, time.monotonic_ns(), window_seconds * NS_PER_SECOND)
+        return max(0, int(max_requests - count))
 
 # Global rate limiter instance
 rate_limiter = RateLimiter()
 
-def rate_limit(max_requests=5, window_seconds=300, block_duration=900):
+def rate_limit(max_requests=5, window_seconds=300, block_duration=900, key_func=None, methods=None):
     """
     Rate limiting decorator
     
@@ -72,12 +151,17 @@ def rate_limit(max_requests=5, window_seconds=300, block_duration=900):
         max_requests: Maximum requests allowed in window
         window_seconds: Time window in seconds
         block_duration: Block duration in seconds
+        key_func: Callable returning the identifier to count against (default: client IP)
+        methods: HTTP methods that are counted (default: all)
     """
     def decorator(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # Use IP address as identifier
-            identifier = get_client_ip()
+            if methods is not None and request.method not in methods:
+                return f(*args, **kwargs)
+            
+            # Use IP address as identifier unless the view supplies its own key
+            identifier = key_func() if key_func else get_client_ip()
             
             if not rate_limiter.is_allowed(identifier, max_requests, window_seconds, block_duration):
                 return jsonify({
@@ -90,50 +174,97 @@ def rate_limit(max_requests=5, window_seconds=300, block_duration=900):
     return decorator
 
 def get_client_ip():
-    """Get client IP address, considering proxies"""
-    x_forwarded_for = request.headers.get('X-Forwarded-For')
-    if x_forwarded_for:
-        return x_forwarded_for.split(',')[0].strip()
-    elif request.headers.get('X-Real-IP'):
-        return request.headers.get('X-Real-IP')
-    else:
-        return request.remote_addr
+    """Get client IP address, considering proxies (resolved once per request)"""
+    ip_address = g.get('_client_ip')
+    if ip_address is None:
+        x_forwarded_for = request.headers.get('X-Forwarded-For')
+        if x_forwarded_for:
+            ip_address = x_forwarded_for.split(',', 1)[0].strip()
+        else:
+            ip_address = request.headers.get('X-Real-IP') or request.remote_addr
+        g._client_ip = ip_address
+    return ip_address
 
 def generate_csrf_token():
-    """Generate CSRF token"""
-    if 'csrf_token' not in session:
-        session['csrf_token'] = hashlib.sha256(
-            f"{session.get('user_id', '')}{time.time()}".encode()
-        ).hexdigest()
-    return session['csrf_token']
+    """Generate CSRF token (looked up once per request, then served from g)"""
+    token = g.get('_csrf_token')
+    if token is None:
+        token = session.get('csrf_token')
+        if token is None:
+            token = session['csrf_token'] = secrets.token_urlsafe(32)
+        g._csrf_token = token
+    return token
 
 def validate_csrf_token(token):
     """Validate CSRF token"""
-    return token and session.get('csrf_token') == token
+    return token and hmac.compare_digest(
+        session.get('csrf_token', '').encode(), token.encode()
+    )
 
-def secure_compare(a, b):
-    """Secure string comparison to prevent timing attacks"""
-    if len(a) != len(b):
-        return False
-    return hmac.compare_digest(a, b)
+# Secure string comparison to prevent timing attacks; compare_digest already
+# handles unequal lengths without revealing where the inputs differ
+secure_compare = hmac.compare_digest
+
+# Events waiting for the writer; once full, new events are dropped and counted
+SECURITY_LOG_QUEUE_SIZE = 10000
+
+# Operators can level, format and route this logger; like app.logger it writes to
+# stderr at INFO when nothing else is configured
+security_logger = logging.getLogger(__name__)
+if security_logger.level == logging.NOTSET:
+    security_logger.setLevel(logging.INFO)
+if not security_logger.hasHandlers():
+    security_logger.addHandler(logging.StreamHandler())
+
+def _write_security_events(events):
+    """Format and write queued security events, off the request path"""
+    reported_drops = 0
+    while True:
+        timestamp, event_type, details, user_id, ip_address, user_agent = events.get()
+        
+        log_entry = {
+            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+            'event_type': event_type,
+            'details': details,
+            'user_id': user_id,
+            'ip_address': ip_address,
+            'user_agent': user_agent
+        }
+        
+        security_logger.info("SECURITY EVENT: %s", log_entry)
+        
+        if dropped_security_events != reported_drops:
+            reported_drops = dropped_security_events
+            security_logger.warning("SECURITY LOG: %d events dropped while the queue was full",
+                                    reported_drops)
+
+def _start_security_log():
+    global _security_events, _dropped_lock, dropped_security_events
+    _security_events = queue.Queue(maxsize=SECURITY_LOG_QUEUE_SIZE)
+    _dropped_lock = threading.Lock()
+    dropped_security_events = 0
+    threading.Thread(target=_write_security_events, args=(_security_events,),
+                     name='security-log', daemon=True).start()
+
+_start_security_log()
+# Threads do not survive fork; give each worker its own queue and writer
+os.register_at_fork(after_in_child=_start_security_log)
 
 def log_security_event(event_type, details, user_id=None):
     """Log security events (in production, this would go to a proper logging system)"""
-    timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
-    ip_address = get_client_ip()
-    user_agent = request.headers.get('User-Agent', 'Unknown')
-    
-    log_entry = {
-        'timestamp': timestamp,
-        'event_type': event_type,
-        'details': details,
-        'user_id': user_id,
-        'ip_address': ip_address,
-        'user_agent': user_agent
-    }
-    
-    # In production, send this to your logging system
-    print(f"SECURITY EVENT: {log_entry}")
+    global dropped_security_events
+    try:
+        _security_events.put_nowait((
+            time.time(), event_type, details, user_id,
+            get_client_ip(), request.headers.get('User-Agent', 'Unknown')
+        ))
+    except queue.Full:
+        # A stalled writer must not grow memory without bound
+        with _dropped_lock:
+            dropped_security_events += 1
+
+_SPECIAL_CHARACTERS = frozenset("!@#$%^&*()_+-=[]{}|;:,.<>?")
+_COMMON_PATTERNS_RE = re.compile(r'123|abc|password|admin|user', re.IGNORECASE)
 
 def check_password_strength(password):
     """
@@ -150,29 +281,40 @@ def check_password_strength(password):
     else:
         feedback.append("Password should be at least 8 characters long")
     
-    if any(c.isupper() for c in password):
+    # One pass over the password sets a bit per character class
+    flags = 0
+    for c in password:
+        if c.isupper():
+            flags |= 1
+        elif c.islower():
+            flags |= 2
+        elif c.isdigit():
+            flags |= 4
+        elif c in _SPECIAL_CHARACTERS:
+            flags |= 8
+    
+    if flags & 1:
         score += 1
     else:
         feedback.append("Password should contain at least one uppercase letter")
     
-    if any(c.islower() for c in password):
+    if flags & 2:
         score += 1
     else:
         feedback.append("Password should contain at least one lowercase letter")
     
-    if any(c.isdigit() for c in password):
+    if flags & 4:
         score += 1
     else:
         feedback.append("Password should contain at least one number")
     
-    if any(c in "!@#$%^&*()_+-=[]{}|;:,.<>?" for c in password):
+    if flags & 8:
         score += 1
     else:
         feedback.append("Password should contain at least one special character")
     
     # Check for common patterns
-    common_patterns = ['123', 'abc', 'password', 'admin', 'user']
-    if any(pattern in password.lower() for pattern in common_patterns):
+    if _COMMON_PATTERNS_RE.search(password):
         score -= 1
         feedback.append("Password should not contain common patterns")
     
@@ -182,13 +324,16 @@ def check_password_strength(password):
         'is_strong': score >= 4
     }
 
+# Control characters other than tab, newline and carriage return map to None (deleted)
+_SANITIZE_TABLE = {i: None for i in range(32) if i not in (9, 10, 13)}
+
 def sanitize_input(input_string, max_length=255):
     """Sanitize user input"""
     if not input_string:
         return ""
     
     # Remove null bytes and control characters
-    sanitized = ''.join(char for char in input_string if ord(char) >= 32 or char in '\t\n\r')
+    sanitized = input_string.translate(_SANITIZE_TABLE)
     
     # Limit length
     return sanitized[:max_length].strip()
@@ -205,29 +350,46 @@ def is_safe_redirect_url(url):
     # In production, you might want to check against allowed domains
     return False
 
+# Seconds between last_activity refreshes; the session expiry slides in steps of this size
+ACTIVITY_UPDATE_INTERVAL = 60
+
 class SessionManager:
     """Manage user sessions with security features"""
     
+    @staticmethod
+    def _timeout_seconds():
+        timeout = current_app.config.get('PERMANENT_SESSION_LIFETIME', 3600)
+        if isinstance(timeout, int):
+            return timeout
+        return timeout.total_seconds()
+    
     @staticmethod
     def create_session(user_id, remember_me=False):
         """Create a new user session"""
+        now = int(time.time())
         session.permanent = remember_me
         session['user_id'] = user_id
-        session['login_time'] = time.time()
-        session['last_activity'] = time.time()
+        session['login_time'] = now
+        session['last_activity'] = now
+        # Expiry travels in the signed cookie, so validity checks need no lookup
+        session['exp'] = now + int(SessionManager._timeout_seconds())
         
         # Generate session token for additional security
-        session['session_token'] = hashlib.sha256(
-            f"{user_id}{time.time()}".encode()
-        ).hexdigest()
+        session['session_token'] = secrets.token_urlsafe(32)
+        
+        g.session_valid = True
         
         log_security_event('user_login', f'User {user_id} logged in', user_id)
     
     @staticmethod
     def update_activity():
-        """Update last activity timestamp"""
+        """Update last activity timestamp, at most once per ACTIVITY_UPDATE_INTERVAL"""
         if 'user_id' in session:
-            session['last_activity'] = time.time()
+            now = int(time.time())
+            if now - session.get('last_activity', 0) < ACTIVITY_UPDATE_INTERVAL:
+                return
+            session['last_activity'] = now
+            session['exp'] = now + int(SessionManager._timeout_seconds())
     
     @staticmethod
     def is_session_valid():
@@ -236,20 +398,20 @@ class SessionManager:
             return False
         
         # Check session timeout
-        last_activity = session.get('last_activity', 0)
-        timeout = current_app.config.get('PERMANENT_SESSION_LIFETIME', 3600)
-        
-        if isinstance(timeout, int):
-            timeout_seconds = timeout
-        else:
-            timeout_seconds = timeout.total_seconds()
-        
-        if time.time() - last_activity > timeout_seconds:
+        if session.get('exp', 0) <= int(time.time()):
             SessionManager.destroy_session()
             return False
         
         return True
     
+    @staticmethod
+    def session_valid():
+        """is_session_valid(), evaluated at most once per request"""
+        valid = g.get('session_valid')
+        if valid is None:
+            valid = g.session_valid = SessionManager.is_session_valid()
+        return valid
+    
     @staticmethod
     def destroy_session():
         """Destroy current session"""
@@ -258,44 +420,55 @@ class SessionManager:
             log_security_event('user_logout', f'User {user_id} logged out', user_id)
         
         session.clear()
+        g.session_valid = False
     
     @staticmethod
     def require_login(f):
         """Decorator to require valid login"""
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if not SessionManager.is_session_valid():
+            if not SessionManager.session_valid():
                 return redirect(url_for('login'))
             
             SessionManager.update_activity()
             return f(*args, **kwargs)
         return decorated_function
 
+def init_session_check(app):
+    """Validate the session once per request and expose the result as g.session_valid"""
+    
+    @app.before_request
+    def check_session():
+        SessionManager.session_valid()
+
+_SECURITY_HEADERS = {
+    # Prevent clickjacking
+    'X-Frame-Options': 'DENY',
+    
+    # Prevent MIME type sniffing
+    'X-Content-Type-Options': 'nosniff',
+    
+    # Enable XSS protection
+    'X-XSS-Protection': '1; mode=block',
+    
+    # Referrer policy
+    'Referrer-Policy': 'strict-origin-when-cross-origin',
+    
+    # Content Security Policy (basic)
+    'Content-Security-Policy': (
+        "default-src 'self'; "
+        "script-src 'self' 'unsafe-inline'; "
+        "style-src 'self' 'unsafe-inline' https://cdnjs.cloudflare.com; "
+        "font-src 'self' https://cdnjs.cloudflare.com; "
+        "img-src 'self' data:; "
+        "connect-src 'self';"
+    ),
+}
+
 def init_security_headers(app):
     """Initialize security headers for the Flask app"""
     
     @app.after_request
     def set_security_headers(response):
-        # Prevent clickjacking
-        response.headers['X-Frame-Options'] = 'DENY'
-        
-        # Prevent MIME type sniffing
-        response.headers['X-Content-Type-Options'] = 'nosniff'
-        
-        # Enable XSS protection
-        response.headers['X-XSS-Protection'] = '1; mode=block'
-        
-        # Referrer policy
-        response.headers['Referrer-Policy'] = 'strict-origin-when-cross-origin'
-        
-        # Content Security Policy (basic)
-        response.headers['Content-Security-Policy'] = (
-            "default-src 'self'; "
-            "script-src 'self' 'unsafe-inline'; "
-            "style-src 'self' 'unsafe-inline' https://cdnjs.cloudflare.com; "
-            "font-src 'self' https://cdnjs.cloudflare.com; "
-            "img-src 'self' data:; "
-            "connect-src 'self';"
-        )
-        
+        response.headers.update(_SECURITY_HEADERS)
         return response
\ No newline at end of file